@@ -0,0 +1,14 @@
+# gunicorn.conf.py -- gunicorn -c gunicorn.conf.py run:app
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+worker_class = "gevent"
+worker_connections = 1000
+timeout = 15
+
+# Appointments live in SQLite (STATE_DB_PATH) and are safe to share between
+# workers. Customers, jobs and pending region lookups are still per-process
+# memory: a customer registered on one worker is unknown to the others, so
+# confirm_booking fails there. Keep one worker; concurrency comes from the
+# gevent connections above.
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
@@ -1,13 +1,56 @@
 # app.py
+# gevent has to patch sockets/threads before requests and urllib3 import them
+try:
+    from gevent import monkey
+    monkey.patch_all()
+except ImportError:  # no gevent: plain threaded server
+    pass
+
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import BadRequest
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
-import uuid
-import json
+import time
+import threading
+import secrets
+import os
+import sqlite3
+import bisect
+from collections import defaultdict
+from functools import lru_cache
+from dataclasses import dataclass, asdict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
 from datetime import datetime, timezone, timedelta
 from typing import List, Dict, Optional
+import numpy as np
+
+class ORJSONProvider(DefaultJSONProvider):
+    # orjson serializes dataclasses natively; anything else goes through
+    # Flask's default hook (Decimal, __html__, ...)
+    def dumps(self, obj, **kwargs) -> str:
+        return self.dumps_bytes(obj).decode()
+
+    def dumps_bytes(self, obj) -> bytes:
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NAIVE_UTC)
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+
+def jsonify_with_fragments(obj: dict, fragments: Dict[str, bytes], status: int = 200):
+    # Like jsonify, but appends already-serialized JSON values as extra keys
+    parts = [orjson.dumps(k) + b":" + v for k, v in fragments.items()]
+    body = app.json.dumps_bytes(obj)
+    if parts:
+        body = body[:-1] + (b"," if obj else b"") + b",".join(parts) + b"}"
+    # trailing newline, as jsonify's responses have
+    return app.response_class(body + b"\n", status=status, mimetype=app.json.mimetype)
 
 # -------------------------
 # Configuration / Mock Data
@@ -88,6 +131,9 @@ REGIONS_CACHE = [
     {"pincode_prefix": "4000xx", "region_label": "Mumbai Suburban"},
     {"pincode_prefix": "1100xx", "region_label": "Delhi"}
 ]
+PREFIX_MAP = {r["pincode_prefix"][:4]: r["region_label"] for r in REGIONS_CACHE}  # e.g. "5600" -> label
+KNOWN_REGION_LABELS = frozenset(PREFIX_MAP.values())
+_LOWER_LABEL_MAP = [(r["region_label"].lower(), r["region_label"]) for r in REGIONS_CACHE]
 
 # Knowledge stubs for adaptive questioning
 KNOWLEDGE_STUBS = {
@@ -123,36 +169,251 @@ KNOWLEDGE_STUBS = {
         "Any unusual noise?"
     ]
 }
+# Immutable, so serialized once and spliced into responses as raw JSON
+KNOWLEDGE_STUBS_JSON = {k: orjson.dumps(v) for k, v in KNOWLEDGE_STUBS.items()}
 
-# In-memory persistence for customers, jobs, appointments
-CUSTOMERS: Dict[str, dict] = {}          # customer_id -> customer data
-JOBS: Dict[str, dict] = {}               # job_id -> job context
-APPOINTMENTS: Dict[str, dict] = {}       # ticket_id -> appointment
+# -------------------------
+# Records
+# -------------------------
+@dataclass(slots=True)
+class Customer:
+    full_name: str
+    phone: str
+    email: str
+    address_text: str
+    pincode: str
+    region_label: str
+    preferred_time_slots: list
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+@dataclass(slots=True)
+class Job:
+    request_type: str
+    appliance_type: str
+    model_if_known: str
+    fault_symptoms: list
+    installation_details: list
+    urgency: str
+    customer_id: str
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+@dataclass(slots=True)
+class Appointment:
+    customer_id: str
+    customer_name: str
+    phone: str
+    email: str
+    address_text: str
+    pincode: str
+    region_label: str
+    appliance_type: str
+    fault_symptoms: list
+    technician_id: str
+    slot_start: str
+    slot_end: str
+    status: str
+    job_id: str
+    created_at: str
+    # set later in the booking lifecycle
+    ticket_id: Optional[str] = None
+    crm_id: Optional[str] = None
+    calendar_id: Optional[str] = None
+    rescheduled_at: Optional[str] = None
+    cancel_reason: Optional[str] = None
+    cancelled_at: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        # lifecycle fields only appear once they have been set
+        return {k: v for k, v in asdict(self).items()
+                if v is not None or k not in _APPOINTMENT_LIFECYCLE_FIELDS}
+
+_APPOINTMENT_LIFECYCLE_FIELDS = frozenset(
+    ("ticket_id", "crm_id", "calendar_id", "rescheduled_at", "cancel_reason", "cancelled_at")
+)
+
+class ShardedDict:
+    # Keys hash onto one of n shards, each behind its own RLock, so writers
+    # on different records rarely contend. lock(key) exposes the shard lock
+    # for read-modify-write sequences on a single record.
+    def __init__(self, n_shards: int = 16):
+        self._shards = [{} for _ in range(n_shards)]
+        self._locks = [threading.RLock() for _ in range(n_shards)]
+
+    def _index(self, key) -> int:
+        return hash(key) % len(self._shards)
+
+    def lock(self, key) -> threading.RLock:
+        return self._locks[self._index(key)]
+
+    def __getitem__(self, key):
+        i = self._index(key)
+        with self._locks[i]:
+            return self._shards[i][key]
+
+    def __setitem__(self, key, value) -> None:
+        i = self._index(key)
+        with self._locks[i]:
+            self._shards[i][key] = value
+
+    def __delitem__(self, key) -> None:
+        i = self._index(key)
+        with self._locks[i]:
+            del self._shards[i][key]
+
+    def __contains__(self, key) -> bool:
+        i = self._index(key)
+        with self._locks[i]:
+            return key in self._shards[i]
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self._shards)
+
+    def get(self, key, default=None):
+        i = self._index(key)
+        with self._locks[i]:
+            return self._shards[i].get(key, default)
+
+    def items(self) -> list:
+        # snapshot, one shard at a time
+        out = []
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                out.extend(shard.items())
+        return out
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+class AppointmentStore:
+    # ticket_id -> Appointment, persisted in SQLite (WAL mode). No in-process
+    # cache: every read goes to the database, so several workers sharing one
+    # file always see each other's writes. Changes to an existing ticket go
+    # through update(), which only touches the named fields.
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS appointments(ticket_id TEXT PRIMARY KEY, data BLOB)")
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def _select(self, ticket_id: str) -> Optional[Appointment]:
+        row = self._db.execute(
+            "SELECT data FROM appointments WHERE ticket_id = ?", (ticket_id,)
+        ).fetchone()
+        return Appointment(**orjson.loads(row[0])) if row else None
+
+    def get(self, ticket_id: str, default=None) -> Optional[Appointment]:
+        with self._lock:
+            appointment = self._select(ticket_id)
+        return appointment if appointment is not None else default
+
+    def insert(self, ticket_id: str, appointment: Appointment) -> None:
+        # new tickets only; raises sqlite3.IntegrityError if the id is taken
+        data = orjson.dumps(appointment)
+        with self._lock:
+            try:
+                self._db.execute("INSERT INTO appointments VALUES (?, ?)", (ticket_id, data))
+            except sqlite3.IntegrityError:
+                self._db.rollback()
+                raise
+            self._db.commit()
+
+    def update(self, ticket_id: str, **fields) -> Optional[Appointment]:
+        # json_set rewrites only these keys in one statement, so concurrent
+        # updates of other fields (from any worker) are never lost.
+        # Returns the fresh record, or None if the ticket doesn't exist.
+        unknown = set(fields) - set(Appointment.__dataclass_fields__)
+        if unknown:
+            raise ValueError(f"unknown appointment fields: {sorted(unknown)}")
+        pairs = ", ".join("?, json(?)" for _ in fields)
+        params = [p for k, v in fields.items() for p in (f"$.{k}", orjson.dumps(v).decode())]
+        with self._lock:
+            cur = self._db.execute(
+                f"UPDATE appointments SET data = json_set(CAST(data AS TEXT), {pairs}) WHERE ticket_id = ?",
+                (*params, ticket_id),
+            )
+            appointment = self._select(ticket_id) if cur.rowcount else None
+            self._db.commit()
+        return appointment
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM appointments").fetchone()[0]
+
+# In-memory persistence for customers and jobs; appointments go to SQLite
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "state.db")
+CUSTOMERS = ShardedDict()     # customer_id -> Customer
+JOBS = ShardedDict()          # job_id -> Job
+APPOINTMENTS = AppointmentStore(STATE_DB_PATH)  # ticket_id -> Appointment
+MASKED_CUSTOMERS: Dict[str, dict] = {}  # customer_id -> PII-masked view for /_debug/state
+
+# Technician indexes, built once at import
+APPL_REGION_IDX: Dict[tuple, set] = defaultdict(set)  # (appliance, region) -> tech ids
+SKILL_IDX: Dict[str, set] = defaultdict(set)          # skill -> tech ids
+TECH_BY_ID: Dict[str, dict] = {}                      # tech id -> technician
+TECH_POS: Dict[str, int] = {}                         # tech id -> position in TECHNICIANS_DATA
+for _pos, _tech in enumerate(TECHNICIANS_DATA):
+    TECH_BY_ID[_tech["id"]] = _tech
+    TECH_POS[_tech["id"]] = _pos
+    for _appl in _tech["appliances_supported"]:
+        for _region in _tech["regions"]:
+            APPL_REGION_IDX[(_appl, _region)].add(_tech["id"])
+    for _skill in _tech["skills"]:
+        SKILL_IDX[_skill].add(_tech["id"])
+    # parsed (start, end) per slot; the ISO strings stay as-is for responses
+    _tech["availability_slots"].sort(key=lambda ts: datetime.fromisoformat(ts["start"]))
+    _tech["_slot_times"] = [
+        (datetime.fromisoformat(ts["start"]), datetime.fromisoformat(ts["end"]))
+        for ts in _tech["availability_slots"]
+    ]
+    # a technician's slots don't overlap, so ends are sorted along with starts
+    _tech["_slot_starts"] = [st for st, _ in _tech["_slot_times"]]
+    _tech["_slot_ends"] = [en for _, en in _tech["_slot_times"]]
+    _tech["_slot_set"] = frozenset((ts["start"], ts["end"]) for ts in _tech["availability_slots"])
 
 
 # -------------------------
 # Validation helpers
 # -------------------------
-PHONE_RE = re.compile(r"^[6-9]\d{9}$")             # Indian mobile numbers
-EMAIL_RE = re.compile(r"^[\w\.-]+@[\w\.-]+\.\w{2,}$")
-PINCODE_RE = re.compile(r"^\d{6}$")
+EMAIL_RE = re.compile(r"^[\w\.-]+@[\w\.-]+\.\w{2,}$", re.ASCII)
+NON_DIGIT_RE = re.compile(r"\D")
 
 def validate_phone(phone: str) -> bool:
-    return bool(PHONE_RE.match(re.sub(r"\D", "", phone)))
+    # Indian mobile numbers: 10 digits starting with 6-9
+    s = phone.strip()
+    if not s.isdecimal():
+        # formatted input such as "98765 43210": drop the separators
+        s = NON_DIGIT_RE.sub("", s)
+    return len(s) == 10 and s[0] in "6789"
 
 def validate_email(email: str) -> bool:
     return bool(EMAIL_RE.match(email.strip()))
 
 def validate_pincode(pincode: str) -> bool:
-    return bool(PINCODE_RE.match(pincode.strip()))
+    s = pincode.strip()
+    return len(s) == 6 and s.isdecimal()
 
 def mask_pii(s: str) -> str:
     if not s: return s
     # simple mask for logs: show first 2 and last 2 digits/letters
-    if "@" in s:
-        parts = s.split("@")
-        return parts[0][:2] + "***@" + parts[1]
-    return s[:2] + "***" + s[-2:]
+    local, at, domain = s.partition("@")
+    if at:
+        return f"{local[:2]}***@{domain}"
+    return f"{s[:2]}***{s[-2:]}" if len(s) >= 4 else "***"
+
+def masked_customer(c: Customer) -> dict:
+    return {**c.to_dict(), "phone": mask_pii(c.phone), "email": mask_pii(c.email)}
+
+def save_customer(customer_id: str, customer: Customer) -> None:
+    # keep the masked debug view in step with every customer write
+    with CUSTOMERS.lock(customer_id):
+        CUSTOMERS[customer_id] = customer
+        MASKED_CUSTOMERS[customer_id] = masked_customer(customer)
 
 
 # -------------------------
@@ -162,6 +423,19 @@ def parse_iso(dt_str: str) -> datetime:
     # Python 3.7+ supports fromisoformat with offset
     return datetime.fromisoformat(dt_str)
 
+# Timestamps are second-precision; the formatted string is reused within a
+# second. A single tuple swap keeps readers from seeing a torn pair.
+_LAST_ISO = (0, "")
+
+def _now_iso() -> str:
+    global _LAST_ISO
+    sec = int(time.time())
+    cached_sec, iso = _LAST_ISO
+    if sec != cached_sec:
+        iso = datetime.fromtimestamp(sec, timezone.utc).isoformat()
+        _LAST_ISO = (sec, iso)
+    return iso
+
 def overlap_slot(pref_start: datetime, pref_end: datetime, tech_start: datetime, tech_end: datetime) -> Optional[tuple]:
     latest_start = max(pref_start, tech_start)
     earliest_end = min(pref_end, tech_end)
@@ -170,55 +444,109 @@ def overlap_slot(pref_start: datetime, pref_end: datetime, tech_start: datetime,
     return None
 
 # -------------------------
-# Pincode lookup with retry + fallback
+# Pincode lookup with retry + cache + fallback
 # -------------------------
-def lookup_region(pincode: str, retries: int = 2, timeout: float = 3.0) -> str:
+# Shared session: pooled keep-alive connections, retries with backoff on 5xx
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=2, backoff_factor=0.3,
+                      status_forcelist=[500, 502, 503, 504],
+                      allowed_methods=["GET"])
+))
+
+@lru_cache(maxsize=4096)
+def _fetch_region(pincode: str, timeout: float) -> str:
+    # Only successful API resolutions are cached: lru_cache does not memoize
+    # raised exceptions, so outages never pin a pincode to the fallback.
     url = f"https://api.zippopotam.us/IN/{pincode}"
-    attempts = 0
-    while attempts <= retries:
-        try:
-            resp = requests.get(url, timeout=timeout)
-            if resp.status_code == 200:
-                js = resp.json()
-                places = js.get("places", [])
-                if places:
-                    # Choose stable field: state (or place name if you prefer)
-                    state = places[0].get("state", "").strip()
-                    place_name = places[0].get("place name", "").strip()
-                    # Try to map to our cached region labels
-                    for r in REGIONS_CACHE:
-                        lab = r["region_label"].lower()
-                        if lab in state.lower() or lab in place_name.lower():
-                            return r["region_label"]
-                    # fallback to 'state' if no mapping
-                    return state or place_name or "Unknown"
-            else:
-                # non-200 treated as failure and retried
-                pass
-        except requests.RequestException:
-            pass
-        attempts += 1
+    try:
+        resp = _SESSION.get(url, timeout=timeout)
+        js = resp.json() if resp.status_code == 200 else {}
+    except requests.RequestException as exc:
+        raise LookupError(f"pincode lookup failed for {pincode}") from exc
+    places = js.get("places", [])
+    if places:
+        # Choose stable field: state (or place name if you prefer)
+        state = places[0].get("state", "").strip()
+        place_name = places[0].get("place name", "").strip()
+        # Try to map to our cached region labels
+        state_l, place_l = state.lower(), place_name.lower()
+        for lab, label in _LOWER_LABEL_MAP:
+            if lab in state_l or lab in place_l:
+                return label
+        # fallback to 'state' if no mapping
+        return state or place_name or "Unknown"
+    raise LookupError(f"pincode lookup failed for {pincode}")
+
+def lookup_region(pincode: str, timeout: float = 3.0) -> str:
+    try:
+        return _fetch_region(pincode, timeout)
+    except LookupError:
+        pass
     # fallback to cached mapping by prefix
-    for r in REGIONS_CACHE:
-        prefix = r["pincode_prefix"][:4]  # e.g., "5600"
-        if pincode.startswith(prefix[:len(prefix)]):
-            return r["region_label"]
-    return "Unknown"
+    return _prefix_lookup(pincode) or "Unknown"
+
+def _prefix_lookup(pincode: str) -> Optional[str]:
+    return PREFIX_MAP.get(pincode[:4])
+
+# -------------------------
+# Background region resolution
+# -------------------------
+# Booking endpoints answer with a provisional region from the prefix table
+# and let the API lookup finish off the request thread.
+_REGION_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+PENDING_REGIONS: Dict[str, Future] = {}  # customer_id -> lookup_region future
+
+def provisional_region(pincode: str) -> str:
+    return _prefix_lookup(pincode) or "Pending"
+
+def resolve_region_async(customer_id: str, pincode: str) -> None:
+    # call once the customer is stored; the result is applied when it lands
+    future = _REGION_EXECUTOR.submit(lookup_region, pincode)
+    PENDING_REGIONS[customer_id] = future
+    future.add_done_callback(lambda f: _apply_region(customer_id, f))
+
+def _apply_region(customer_id: str, future: Future) -> None:
+    with CUSTOMERS.lock(customer_id):
+        # a newer change_address may have replaced this lookup meanwhile
+        if PENDING_REGIONS.get(customer_id) is not future:
+            return
+        del PENDING_REGIONS[customer_id]
+        customer = CUSTOMERS.get(customer_id)
+        if customer is None or future.cancelled() or future.exception() is not None:
+            return  # keep the provisional label
+        region_label = future.result()
+        if region_label not in KNOWN_REGION_LABELS and _prefix_lookup(customer.pincode):
+            # technicians were matched against the prefix label; a raw API
+            # state ("Karnataka") must not silently replace it
+            return
+        customer.region_label = region_label
+        save_customer(customer_id, customer)
+
+def finalize_region(customer_id: str, timeout: float = 0.1) -> None:
+    # best effort: give a nearly-finished lookup a moment before booking
+    future = PENDING_REGIONS.get(customer_id)
+    if future is None:
+        return
+    try:
+        future.result(timeout=timeout)
+    except FutureTimeout:
+        return  # still resolving; the done callback applies it later
+    _apply_region(customer_id, future)
 
 # -------------------------
 # Scheduling logic
 # -------------------------
 def find_technicians_for(appliance: str, required_skill: Optional[str], region_label: str) -> List[dict]:
-    matches = []
-    for tech in TECHNICIANS_DATA:
-        if appliance in tech["appliances_supported"]:
-            if region_label in tech["regions"]:
-                if required_skill:
-                    if required_skill in tech["skills"]:
-                        matches.append(tech)
-                else:
-                    matches.append(tech)
-    return matches
+    ids = APPL_REGION_IDX.get((appliance, region_label), set())
+    if required_skill:
+        # a non-string skill (e.g. a nested list from fault_symptoms) matches nobody
+        skill_ids = SKILL_IDX.get(required_skill, set()) if isinstance(required_skill, str) else set()
+        ids = ids & skill_ids
+    # keep TECHNICIANS_DATA order so techs[0] stays the preferred match
+    return [TECH_BY_ID[i] for i in sorted(ids, key=TECH_POS.__getitem__)]
 
 def propose_slots(tech: dict, customer_pref_slots: List[dict], max_proposals: int = 2) -> List[dict]:
     proposals = []
@@ -229,12 +557,10 @@ def propose_slots(tech: dict, customer_pref_slots: List[dict], max_proposals: in
             pref_end = parse_iso(pref["end"])
         except Exception:
             continue
-        for ts in tech["availability_slots"]:
-            try:
-                tech_start = parse_iso(ts["start"])
-                tech_end = parse_iso(ts["end"])
-            except Exception:
-                continue
+        # only slots with end > pref_start and start < pref_end can overlap
+        lo = bisect.bisect_right(tech["_slot_ends"], pref_start)
+        hi = bisect.bisect_left(tech["_slot_starts"], pref_end)
+        for tech_start, tech_end in tech["_slot_times"][lo:hi]:
             ov = overlap_slot(pref_start, pref_end, tech_start, tech_end)
             if ov:
                 proposals.append({"start": ov[0].isoformat(), "end": ov[1].isoformat(), "technician_id": tech["id"]})
@@ -247,54 +573,112 @@ def propose_slots(tech: dict, customer_pref_slots: List[dict], max_proposals: in
             break
     return proposals
 
-def persist_appointment(appointment: dict) -> str:
-    ticket_id = f"TK-{uuid.uuid4().hex[:8]}"
-    APPOINTMENTS[ticket_id] = appointment
-    # optional: write to disk for judges (not required)
-    # with open("appointments.json", "w") as f:
-    #     json.dump(APPOINTMENTS, f, indent=2)
-    return ticket_id
+# -------------------------
+# Bulk scheduling (vectorized)
+# -------------------------
+# Every technician slot flattened into int64 unix-microsecond columns, so
+# batch runs can test many preference windows against all slots at once.
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def to_unix_us(dt: datetime) -> int:
+    return (dt - _EPOCH) // timedelta(microseconds=1)
+
+TECH_START_US = np.array([to_unix_us(st) for t in TECHNICIANS_DATA for st, _ in t["_slot_times"]], dtype=np.int64)
+TECH_END_US = np.array([to_unix_us(en) for t in TECHNICIANS_DATA for _, en in t["_slot_times"]], dtype=np.int64)
+TECH_OWNER_ID = np.array([t["id"] for t in TECHNICIANS_DATA for _ in t["_slot_times"]])
+
+def batch_propose(pref_starts_us, pref_ends_us) -> tuple:
+    # Overlaps of P preference windows x S technician slots in one broadcast
+    # pass. Returns (pref_idx, technician_id, start_us, end_us) arrays, one
+    # entry per overlap. Single-request endpoints keep using propose_slots.
+    #
+    # Called from batch jobs, not from an endpoint, e.g.:
+    #   from run import batch_propose, to_unix_us, parse_iso
+    #   starts = [to_unix_us(parse_iso(p["start"])) for p in prefs]
+    #   ends = [to_unix_us(parse_iso(p["end"])) for p in prefs]
+    #   pref_idx, tech_ids, start_us, end_us = batch_propose(starts, ends)
+    pref_starts = np.asarray(pref_starts_us, dtype=np.int64)[:, None]
+    pref_ends = np.asarray(pref_ends_us, dtype=np.int64)[:, None]
+    latest_start = np.maximum(pref_starts, TECH_START_US)
+    earliest_end = np.minimum(pref_ends, TECH_END_US)
+    pref_idx, slot_idx = np.nonzero(latest_start < earliest_end)
+    return (pref_idx, TECH_OWNER_ID[slot_idx],
+            latest_start[pref_idx, slot_idx], earliest_end[pref_idx, slot_idx])
+
+def persist_appointment(appointment: Appointment) -> str:
+    while True:
+        ticket_id = f"TK-{secrets.token_hex(4)}"
+        appointment.ticket_id = ticket_id
+        try:
+            APPOINTMENTS.insert(ticket_id, appointment)
+        except sqlite3.IntegrityError:
+            continue  # id collision with an existing ticket; draw another
+        return ticket_id
 
 # -------------------------
 # Integration placeholders
 # -------------------------
-def create_crm_ticket(appointment: dict) -> str:
+def create_crm_ticket(appointment: Appointment) -> str:
     # Placeholder to integrate with a CRM (return crm_ticket_id)
     # e.g., call CRM API and return created ticket id
     print("[INTEGRATION] create_crm_ticket called (placeholder)")
     return "CRM-PLACEHOLDER"
 
-def sync_calendar(appointment: dict) -> str:
+def sync_calendar(appointment: Appointment) -> str:
     # Placeholder to integrate with calendar API (Google Calendar / Outlook)
     print("[INTEGRATION] sync_calendar called (placeholder)")
     return "CAL-PLACEHOLDER"
 
 def warm_transfer_payload(appointment: dict) -> dict:
     # Create a compact summary for human agent warm transfer
+    phone = str(appointment.get("phone") or "")
     summary = {
         "customer": appointment.get("customer_name"),
-        "phone": appointment.get("phone")[:2] + "***" + appointment.get("phone")[-2:],
+        "phone": mask_pii(phone) or "***",
         "appliance": appointment.get("appliance_type"),
         "fault_symptoms": appointment.get("fault_symptoms"),
         "attempted_slots": appointment.get("proposed_slots", [])
     }
     return summary
 
+# -------------------------
+# Request parsing
+# -------------------------
+def json_payload() -> dict:
+    # decode the raw body with orjson instead of going through request.json
+    data = request.get_data()
+    if not data:
+        return {}
+    try:
+        payload = orjson.loads(data)
+    except orjson.JSONDecodeError:
+        raise BadRequest("malformed JSON body")
+    return payload if isinstance(payload, dict) else {}
+
+def get_stripped(params, key: str, default: str = "") -> str:
+    # non-string values (null, numbers, lists) count as missing
+    value = params.get(key, default)
+    return value.strip() if isinstance(value, str) else default
+
+def non_string_field(params, keys) -> Optional[str]:
+    # first key that is present with a non-string value, if any
+    return next((k for k in keys if k in params and not isinstance(params[k], str)), None)
+
 # -------------------------
 # Endpoints (Intent handlers)
 # -------------------------
 
 @app.route("/register_service_issue", methods=["POST"])
 def register_service_issue():
-    payload = request.json or {}
+    payload = json_payload()
     # Capture and validate critical entities
-    full_name = payload.get("full_name", "").strip()
-    phone = payload.get("phone", "").strip()
-    email = payload.get("email", "").strip()
-    address_text = payload.get("address_text", "").strip()
-    pincode = payload.get("pincode", "").strip()
+    full_name = get_stripped(payload, "full_name")
+    phone = get_stripped(payload, "phone")
+    email = get_stripped(payload, "email")
+    address_text = get_stripped(payload, "address_text")
+    pincode = get_stripped(payload, "pincode")
     preferred_time_slots = payload.get("preferred_time_slots", [])
-    appliance_type = payload.get("appliance_type", "").strip()
+    appliance_type = get_stripped(payload, "appliance_type")
     fault_symptoms = payload.get("fault_symptoms", [])
     urgency = payload.get("urgency", "normal")
 
@@ -312,8 +696,9 @@ def register_service_issue():
     if errors:
         return jsonify({"status":"error","errors":errors}), 400
 
-    # Lookup region (with retry and fallback)
-    region_label = lookup_region(pincode)
+    # Provisional region now; API lookup (with retry and fallback) runs in background
+    customer_id = f"CUST-{secrets.token_hex(4)}"
+    region_label = provisional_region(pincode)
 
     # Simple triage: take first symptom as required skill mapping if present
     required_skill = fault_symptoms[0] if fault_symptoms else None
@@ -326,35 +711,38 @@ def register_service_issue():
     if techs:
         proposals = propose_slots(techs[0], preferred_time_slots or [])
         # ensure at least two proposals: try to get from more technicians
+        seen = {(p["start"], p["end"], p["technician_id"]) for p in proposals}
         idx = 0
         while len(proposals) < 2 and idx+1 < len(techs):
             more = propose_slots(techs[idx+1], preferred_time_slots or [])
             for p in more:
-                if p not in proposals:
+                key = (p["start"], p["end"], p["technician_id"])
+                if key not in seen:
+                    seen.add(key)
                     proposals.append(p)
             idx += 1
 
     # Persist customer & job context
-    customer_id = f"CUST-{uuid.uuid4().hex[:8]}"
-    CUSTOMERS[customer_id] = {
-        "full_name": full_name,
-        "phone": phone,
-        "email": email,
-        "address_text": address_text,
-        "pincode": pincode,
-        "region_label": region_label,
-        "preferred_time_slots": preferred_time_slots
-    }
-    job_id = f"JOB-{uuid.uuid4().hex[:8]}"
-    JOBS[job_id] = {
-        "request_type": "service",
-        "appliance_type": appliance_type,
-        "model_if_known": payload.get("model_if_known", ""),
-        "fault_symptoms": fault_symptoms,
-        "installation_details": [],
-        "urgency": urgency,
-        "customer_id": customer_id
-    }
+    save_customer(customer_id, Customer(
+        full_name=full_name,
+        phone=phone,
+        email=email,
+        address_text=address_text,
+        pincode=pincode,
+        region_label=region_label,
+        preferred_time_slots=preferred_time_slots
+    ))
+    resolve_region_async(customer_id, pincode)
+    job_id = f"JOB-{secrets.token_hex(4)}"
+    JOBS[job_id] = Job(
+        request_type="service",
+        appliance_type=appliance_type,
+        model_if_known=payload.get("model_if_known", ""),
+        fault_symptoms=fault_symptoms,
+        installation_details=[],
+        urgency=urgency,
+        customer_id=customer_id
+    )
 
     # Build triage response
     response = {
@@ -363,27 +751,27 @@ def register_service_issue():
         "job_id": job_id,
         "region_label": region_label,
         "matched_tech_count": len(techs),
-        "proposed_slots": proposals,
-        "knowledge_questions": KNOWLEDGE_STUBS.get(appliance_type, [])
+        "proposed_slots": proposals
     }
+    knowledge_questions = KNOWLEDGE_STUBS_JSON.get(appliance_type, b"[]")
 
     # Log (masked)
     print(f"[LOG] register_service_issue: customer={mask_pii(full_name)}, phone={mask_pii(phone)}, region={region_label}")
 
-    return jsonify(response), 200
+    return jsonify_with_fragments(response, {"knowledge_questions": knowledge_questions})
 
 
 @app.route("/book_installation", methods=["POST"])
 def book_installation():
-    payload = request.json or {}
+    payload = json_payload()
     # For installation flow, reuse same structure but different request_type
     # Validate similar fields
-    full_name = payload.get("full_name", "").strip()
-    phone = payload.get("phone", "").strip()
-    pincode = payload.get("pincode", "").strip()
-    appliance_type = payload.get("appliance_type", "").strip()
+    full_name = get_stripped(payload, "full_name")
+    phone = get_stripped(payload, "phone")
+    pincode = get_stripped(payload, "pincode")
+    appliance_type = get_stripped(payload, "appliance_type")
     preferred_time_slots = payload.get("preferred_time_slots", [])
-    email = payload.get("email", "").strip()
+    email = get_stripped(payload, "email")
 
     errors = []
     if not full_name:
@@ -399,7 +787,8 @@ def book_installation():
     if errors:
         return jsonify({"status":"error","errors":errors}), 400
 
-    region_label = lookup_region(pincode)
+    customer_id = f"CUST-{secrets.token_hex(4)}"
+    region_label = provisional_region(pincode)
     # For installation, skill is generic installation for appliance
     required_skill = f"install_{appliance_type.lower()}"
     techs = find_technicians_for(appliance_type, None, region_label)
@@ -408,35 +797,38 @@ def book_installation():
     if techs:
         proposals = propose_slots(techs[0], preferred_time_slots or [])
         # aim to propose two
+        seen = {(p["start"], p["end"], p["technician_id"]) for p in proposals}
         idx = 0
         while len(proposals) < 2 and idx+1 < len(techs):
             more = propose_slots(techs[idx+1], preferred_time_slots or [])
             for p in more:
-                if p not in proposals:
+                key = (p["start"], p["end"], p["technician_id"])
+                if key not in seen:
+                    seen.add(key)
                     proposals.append(p)
             idx += 1
 
     # create customer/job
-    customer_id = f"CUST-{uuid.uuid4().hex[:8]}"
-    CUSTOMERS[customer_id] = {
-        "full_name": full_name,
-        "phone": phone,
-        "email": email,
-        "address_text": payload.get("address_text", ""),
-        "pincode": pincode,
-        "region_label": region_label,
-        "preferred_time_slots": preferred_time_slots
-    }
-    job_id = f"JOB-{uuid.uuid4().hex[:8]}"
-    JOBS[job_id] = {
-        "request_type": "installation",
-        "appliance_type": appliance_type,
-        "model_if_known": payload.get("model_if_known", ""),
-        "fault_symptoms": [],
-        "installation_details": payload.get("installation_details", []),
-        "urgency": payload.get("urgency", "normal"),
-        "customer_id": customer_id
-    }
+    save_customer(customer_id, Customer(
+        full_name=full_name,
+        phone=phone,
+        email=email,
+        address_text=payload.get("address_text", ""),
+        pincode=pincode,
+        region_label=region_label,
+        preferred_time_slots=preferred_time_slots
+    ))
+    resolve_region_async(customer_id, pincode)
+    job_id = f"JOB-{secrets.token_hex(4)}"
+    JOBS[job_id] = Job(
+        request_type="installation",
+        appliance_type=appliance_type,
+        model_if_known=payload.get("model_if_known", ""),
+        fault_symptoms=[],
+        installation_details=payload.get("installation_details", []),
+        urgency=payload.get("urgency", "normal"),
+        customer_id=customer_id
+    )
 
     print(f"[LOG] book_installation: customer={mask_pii(full_name)}, pincode={pincode}, region={region_label}")
 
@@ -452,23 +844,22 @@ def book_installation():
 @app.route("/ask_availability", methods=["GET"])
 def ask_availability():
     # Query params: pincode, appliance
-    pincode = request.args.get("pincode", "").strip()
-    appliance = request.args.get("appliance", "").strip()
+    pincode = get_stripped(request.args, "pincode")
+    appliance = get_stripped(request.args, "appliance")
     if not validate_pincode(pincode) or not appliance:
         return jsonify({"error": "pincode and appliance required"}), 400
     region_label = lookup_region(pincode)
     # collect available technicians and their first 2 slots
     results = []
-    for tech in TECHNICIANS_DATA:
-        if appliance in tech["appliances_supported"] and region_label in tech["regions"]:
-            slots = tech.get("availability_slots", [])[:2]
-            results.append({"technician_id": tech["id"], "technician_name": tech["name"], "slots": slots})
+    for tech in find_technicians_for(appliance, None, region_label):
+        slots = tech.get("availability_slots", [])[:2]
+        results.append({"technician_id": tech["id"], "technician_name": tech["name"], "slots": slots})
     return jsonify({"region_label": region_label, "availability": results}), 200
 
 
 @app.route("/confirm_booking", methods=["POST"])
 def confirm_booking():
-    payload = request.json or {}
+    payload = json_payload()
     # requires customer_id, job_id, chosen_slot (start,end), technician_id
     customer_id = payload.get("customer_id")
     job_id = payload.get("job_id")
@@ -481,43 +872,41 @@ def confirm_booking():
     job = JOBS.get(job_id)
     if not customer or not job:
         return jsonify({"error":"invalid customer_id or job_id"}), 400
-
-    appointment = {
-        "customer_id": customer_id,
-        "customer_name": customer.get("full_name"),
-        "phone": customer.get("phone"),
-        "email": customer.get("email"),
-        "address_text": customer.get("address_text"),
-        "pincode": customer.get("pincode"),
-        "region_label": customer.get("region_label"),
-        "appliance_type": job.get("appliance_type"),
-        "fault_symptoms": job.get("fault_symptoms"),
-        "technician_id": technician_id,
-        "slot_start": chosen_slot.get("start"),
-        "slot_end": chosen_slot.get("end"),
-        "status": "confirmed",
-        "job_id": job_id,
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
-
-    ticket_id = persist_appointment(appointment)
+    finalize_region(customer_id)
+
+    appointment = Appointment(
+        customer_id=customer_id,
+        customer_name=customer.full_name,
+        phone=customer.phone,
+        email=customer.email,
+        address_text=customer.address_text,
+        pincode=customer.pincode,
+        region_label=customer.region_label,
+        appliance_type=job.appliance_type,
+        fault_symptoms=job.fault_symptoms,
+        technician_id=technician_id,
+        slot_start=chosen_slot.get("start"),
+        slot_end=chosen_slot.get("end"),
+        status="confirmed",
+        job_id=job_id,
+        created_at=_now_iso()
+    )
 
     # Integration placeholders
-    crm_id = create_crm_ticket(appointment)
-    cal_id = sync_calendar(appointment)
+    appointment.crm_id = create_crm_ticket(appointment)
+    appointment.calendar_id = sync_calendar(appointment)
 
-    appointment["ticket_id"] = ticket_id
-    appointment["crm_id"] = crm_id
-    appointment["calendar_id"] = cal_id
+    # one insert (and commit) with every id already set
+    ticket_id = persist_appointment(appointment)
 
-    print(f"[LOG] Booking confirmed: ticket={ticket_id}, customer={mask_pii(customer.get('full_name'))}")
+    print(f"[LOG] Booking confirmed: ticket={ticket_id}, customer={mask_pii(customer.full_name)}")
 
-    return jsonify({"status":"ok", "ticket_id": ticket_id, "appointment": appointment}), 200
+    return jsonify({"status":"ok", "ticket_id": ticket_id, "appointment": appointment.to_dict()}), 200
 
 
 @app.route("/reschedule", methods=["POST"])
 def reschedule():
-    payload = request.json or {}
+    payload = json_payload()
     ticket_id = payload.get("ticket_id")
     new_slot = payload.get("new_slot")
     if not ticket_id or not new_slot:
@@ -527,103 +916,123 @@ def reschedule():
         return jsonify({"error":"ticket not found"}), 404
 
     # Try to find if technician has this new_slot available
-    tech = next((t for t in TECHNICIANS_DATA if t["id"] == appointment["technician_id"]), None)
+    tech = TECH_BY_ID.get(appointment.technician_id)
     if not tech:
         return jsonify({"error":"technician not found"}), 404
 
     # Check overlap - simple equality check against tech availability slots
-    match = False
-    for ts in tech["availability_slots"]:
-        if ts["start"] == new_slot.get("start") and ts["end"] == new_slot.get("end"):
-            match = True
-            break
-
-    if not match:
+    # (non-string start/end can't match and would not hash)
+    new_key = (new_slot.get("start"), new_slot.get("end"))
+    if not all(isinstance(v, str) for v in new_key) or new_key not in tech["_slot_set"]:
         # propose alternative
         alt = tech["availability_slots"][0]
         return jsonify({"status":"no", "message":"requested slot not available", "alternative_slot": alt}), 200
 
     # update appointment
-    appointment["slot_start"] = new_slot.get("start")
-    appointment["slot_end"] = new_slot.get("end")
-    appointment["status"] = "rescheduled"
-    appointment["rescheduled_at"] = datetime.now(timezone.utc).isoformat()
+    appointment = APPOINTMENTS.update(
+        ticket_id,
+        slot_start=new_slot.get("start"),
+        slot_end=new_slot.get("end"),
+        status="rescheduled",
+        rescheduled_at=_now_iso(),
+    )
+    if not appointment:
+        return jsonify({"error":"ticket not found"}), 404
     print(f"[LOG] Rescheduled ticket={ticket_id}")
-    return jsonify({"status":"ok", "ticket_id": ticket_id, "appointment": appointment}), 200
+    return jsonify({"status":"ok", "ticket_id": ticket_id, "appointment": appointment.to_dict()}), 200
 
 
 @app.route("/cancel", methods=["POST"])
 def cancel():
-    payload = request.json or {}
+    payload = json_payload()
     ticket_id = payload.get("ticket_id")
     reason = payload.get("reason", "")
     if not ticket_id:
         return jsonify({"error":"ticket_id required"}), 400
-    appointment = APPOINTMENTS.get(ticket_id)
+    appointment = APPOINTMENTS.update(
+        ticket_id,
+        status="cancelled",
+        cancel_reason=reason,
+        cancelled_at=_now_iso(),
+    )
     if not appointment:
         return jsonify({"error":"ticket not found"}), 404
-    appointment["status"] = "cancelled"
-    appointment["cancel_reason"] = reason
-    appointment["cancelled_at"] = datetime.now(timezone.utc).isoformat()
     print(f"[LOG] Cancelled ticket={ticket_id}")
     return jsonify({"status":"ok","ticket_id":ticket_id}), 200
 
 
 @app.route("/update_contact", methods=["POST"])
 def update_contact():
-    payload = request.json or {}
+    payload = json_payload()
     customer_id = payload.get("customer_id")
-    phone = payload.get("phone")
-    email = payload.get("email")
+    phone = get_stripped(payload, "phone")
+    email = get_stripped(payload, "email")
     if not customer_id:
         return jsonify({"error":"customer_id required"}), 400
-    customer = CUSTOMERS.get(customer_id)
-    if not customer:
-        return jsonify({"error":"customer not found"}), 404
-    if phone:
-        if not validate_phone(phone):
+    bad_field = non_string_field(payload, ("phone", "email"))
+    if bad_field:
+        return jsonify({"error":f"invalid {bad_field}"}), 400
+    with CUSTOMERS.lock(customer_id):
+        customer = CUSTOMERS.get(customer_id)
+        if not customer:
+            return jsonify({"error":"customer not found"}), 404
+        # validate everything before touching the record
+        if phone and not validate_phone(phone):
             return jsonify({"error":"invalid phone"}), 400
-        customer["phone"] = phone
-    if email:
-        if not validate_email(email):
+        if email and not validate_email(email):
             return jsonify({"error":"invalid email"}), 400
-        customer["email"] = email
+        if phone:
+            customer.phone = phone
+        if email:
+            customer.email = email
+        save_customer(customer_id, customer)
+        snapshot = customer.to_dict()
     print(f"[LOG] Updated contact for customer={customer_id}")
-    return jsonify({"status":"ok","customer":customer}), 200
+    return jsonify({"status":"ok","customer":snapshot}), 200
 
 
 @app.route("/change_address", methods=["POST"])
 def change_address():
-    payload = request.json or {}
+    payload = json_payload()
     customer_id = payload.get("customer_id")
-    address_text = payload.get("address_text", "")
-    pincode = payload.get("pincode", "")
+    address_text = get_stripped(payload, "address_text")
+    pincode = get_stripped(payload, "pincode")
     if not customer_id:
         return jsonify({"error":"customer_id required"}), 400
-    customer = CUSTOMERS.get(customer_id)
-    if not customer:
-        return jsonify({"error":"customer not found"}), 404
-    if address_text:
-        customer["address_text"] = address_text
-    if pincode:
-        if not validate_pincode(pincode):
+    bad_field = non_string_field(payload, ("address_text", "pincode"))
+    if bad_field:
+        return jsonify({"error":f"invalid {bad_field}"}), 400
+    with CUSTOMERS.lock(customer_id):
+        customer = CUSTOMERS.get(customer_id)
+        if not customer:
+            return jsonify({"error":"customer not found"}), 404
+        # validate everything before touching the record
+        if pincode and not validate_pincode(pincode):
             return jsonify({"error":"invalid pincode"}), 400
-        customer["pincode"] = pincode
-        customer["region_label"] = lookup_region(pincode)
+        if address_text:
+            customer.address_text = address_text
+        if pincode:
+            customer.pincode = pincode
+            customer.region_label = provisional_region(pincode)
+            resolve_region_async(customer_id, pincode)
+        save_customer(customer_id, customer)
+        snapshot = customer.to_dict()
     print(f"[LOG] Address updated for customer={customer_id}")
-    return jsonify({"status":"ok","customer":customer}), 200
+    return jsonify({"status":"ok","customer":snapshot}), 200
 
 
 @app.route("/escalate_to_human", methods=["POST"])
 def escalate_to_human():
-    payload = request.json or {}
+    payload = json_payload()
     ticket_id = payload.get("ticket_id")
     reason = payload.get("reason", "")
     appointment = APPOINTMENTS.get(ticket_id) if ticket_id else None
-    if not appointment:
+    if appointment:
+        context = appointment.to_dict()
+    else:
         # If no ticket, still allow escalation with context from payload
-        appointment = payload.get("context", {})
-    summary = warm_transfer_payload(appointment)
+        context = payload.get("context", {})
+    summary = warm_transfer_payload(context)
     summary["reason"] = reason
     # In a real system, call transfer API here; return payload for human agent
     print(f"[LOG] Escalation requested. Summary: {summary}")
@@ -635,16 +1044,10 @@ def escalate_to_human():
 # -------------------------
 @app.route("/_debug/state", methods=["GET"])
 def debug_state():
-    # mask PII in output
-    masked_customers = {}
-    for cid, c in CUSTOMERS.items():
-        masked = c.copy()
-        masked["phone"] = mask_pii(masked.get("phone",""))
-        masked["email"] = mask_pii(masked.get("email",""))
-        masked_customers[cid] = masked
+    # PII is masked at write time (see save_customer)
     return jsonify({
-        "customers": masked_customers,
-        "jobs": JOBS,
+        "customers": MASKED_CUSTOMERS,
+        "jobs": JOBS.to_dict(),
         "appointments_count": len(APPOINTMENTS),
         "technicians_count": len(TECHNICIANS_DATA)
     }), 200
@@ -653,4 +1056,5 @@ def debug_state():
 # Run
 # -------------------------
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    # local runs only; serve with `gunicorn -c gunicorn.conf.py run:app`
+    app.run(host="0.0.0.0", port=5000)